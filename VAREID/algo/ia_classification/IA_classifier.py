@@ -1,5 +1,6 @@
 import argparse
 import ast
+import functools
 import os
 import shutil
 import warnings
@@ -9,49 +10,80 @@ import numpy as np
 import pandas as pd
 import torch
 import yaml
-from PIL import Image
 from torch import nn
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
-from torchvision.transforms import functional as F
+from torchvision.io import ImageReadMode, decode_image, decode_jpeg, read_file, read_image
+from torchvision.transforms import v2
 from torchvision.models import resnet50
-from torchvision.ops import nms
+from torchvision.ops import batched_nms
 
-from VAREID.libraries.io.format_funcs import load_config, load_json, save_json, split_dataframe, join_dataframe
+from VAREID.libraries.io.format_funcs import load_config, load_json, save_split_dataframe, join_dataframe
 from VAREID.libraries.utils import path_from_file
 
 
-def xywh_to_xyxy(bbox: list):
-    x, y, w, h = bbox
-    x1 = x
-    y1 = y
-    x2 = x + w
-    y2 = y + h
-    return [x1, y1, x2, y2]
+XYXY_COLS = ["x1", "y1", "x2", "y2"]
+
+
+def crop_bbox(image, x1, y1, x2, y2):
+    """
+    Crop a CHW image tensor to the integer box (x1, y1, x2, y2), matching PIL's
+    Image.crop: any part of the box outside the image is zero-padded, so the crop
+    always has the full bbox size (and aspect ratio).
+    """
+    height, width = image.shape[-2:]
+    sx1, sy1 = min(max(x1, 0), width), min(max(y1, 0), height)
+    sx2, sy2 = max(min(x2, width), sx1), max(min(y2, height), sy1)
+    if (sx1, sy1, sx2, sy2) == (x1, y1, x2, y2):
+        return image[:, y1:y2, x1:x2]
+
+    crop = image.new_zeros((image.shape[0], y2 - y1, x2 - x1))
+    crop[:, sy1 - y1 : sy2 - y1, sx1 - x1 : sx2 - x1] = image[:, sy1:sy2, sx1:sx2]
+    return crop
+
+
+def crop_arrays(dataframe):
+    """Integer xyxy crop boxes (N, 4) and left-viewpoint flip flags (N,) for every row"""
+    boxes = dataframe[XYXY_COLS].to_numpy().astype(np.int64)
+    is_left = dataframe["viewpoint"].str.contains("left").to_numpy(dtype=bool)
+    return boxes, is_left
+
+
+def is_jpeg_data(data):
+    # Decide from the JPEG SOI marker rather than the file extension
+    return data[:2].tolist() == [0xFF, 0xD8]
+
+
+@functools.lru_cache(maxsize=4)
+def read_rgb_image(path):
+    # Cached per process (each DataLoader worker has its own), so consecutive
+    # annotations on the same image only decode it once
+    return read_image(path, mode=ImageReadMode.RGB)
 
 
 class CustomImageDataset(Dataset):
     def __init__(self, dataframe, transform=None):
-        self.img_data = dataframe
+        # Pull the needed columns into plain arrays so __getitem__ avoids pandas row lookups
+        self.paths = dataframe["image_path"].to_numpy()
+        self.boxes, self.is_left = crop_arrays(dataframe)
         self.transform = transform
 
     def __len__(self):
-        return len(self.img_data)
+        return len(self.paths)
 
     def __getitem__(self, idx):
 
-        # Read image as PIL Image
-        image = Image.open(self.img_data.iloc[idx]["image_path"]).convert("RGB")
+        # Read image as a uint8 CHW tensor
+        image = read_rgb_image(self.paths[idx])
 
         # Get the bounding box coordinates
-        bbox = xywh_to_xyxy(self.img_data.iloc[idx]["bbox"])
+        x1, y1, x2, y2 = self.boxes[idx].tolist()
 
-        # Crop the image according to bbox
-        image = image.crop((int(bbox[0]), int(bbox[1]), int(bbox[2]), int(bbox[3])))
+        # Crop the image according to bbox (zero-padded past the image edges, like PIL)
+        image = crop_bbox(image, x1, y1, x2, y2)
 
         # Flip the image if left viewpoint
-        if "left" in self.img_data.iloc[idx]["viewpoint"]:
-            image = F.hflip(image)
+        if self.is_left[idx]:
+            image = image.flip(-1)
 
         if self.transform:
             image = self.transform(image)
@@ -59,6 +91,64 @@ class CustomImageDataset(Dataset):
         return image
 
 
+class ImageCropsDataset(Dataset):
+    """
+    One item per source image: its raw encoded bytes plus every crop on it, so the
+    image is decoded once (on the GPU, see gpu_crop_batches) rather than once per bbox.
+    Consecutive rows with the same image_path form one item, so crops keep the
+    dataframe's row order.
+    """
+
+    def __init__(self, dataframe):
+        paths = dataframe["image_path"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, paths[1:] != paths[:-1]]) if len(paths) else []
+        self.groups = list(zip(starts, np.r_[starts[1:], len(paths)]))
+        self.paths = paths
+
+        self.boxes, self.is_left = crop_arrays(dataframe)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __getitem__(self, idx):
+        start, end = self.groups[idx]
+        return (
+            read_file(self.paths[start]),
+            torch.from_numpy(self.boxes[start:end]),
+            torch.from_numpy(self.is_left[start:end]),
+        )
+
+
+def collate_images(batch):
+    # Images have different sizes and crop counts, so keep them as a list
+    return batch
+
+
+def gpu_crop_batches(dataloader, transform, device, batch_size):
+    """Decode each image once on the device (nvJPEG) and yield fixed-size batches of crops"""
+    pending = []
+    for images in dataloader:
+        for data, boxes, is_left in images:
+            if is_jpeg_data(data):
+                image = decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+            else:
+                # nvJPEG only handles JPEGs; decode anything else on the CPU
+                image = decode_image(data, mode=ImageReadMode.RGB).to(device)
+
+            for (x1, y1, x2, y2), flip in zip(boxes.tolist(), is_left.tolist()):
+                crop = crop_bbox(image, x1, y1, x2, y2)
+                if flip:
+                    crop = crop.flip(-1)
+                pending.append(transform(crop))
+
+            while len(pending) >= batch_size:
+                yield torch.stack(pending[:batch_size])
+                pending = pending[batch_size:]
+
+    if pending:
+        yield torch.stack(pending)
+
+
 class BinaryClassResNet50(nn.Module):
     def __init__(self):
         super(BinaryClassResNet50, self).__init__()
@@ -76,7 +166,7 @@ class BinaryClassResNet50(nn.Module):
 def load_model(model_path, device):
     model = BinaryClassResNet50()
     model.load_state_dict(torch.load(model_path, map_location=device))
-    model.to(device)
+    model.to(device, memory_format=torch.channels_last)
     model.eval()
     return model
 
@@ -104,39 +194,73 @@ def filter_dataframe(df, config):
     return filtered_test, filtered_out
 
 
-def test_new(dataloader, model, device):
+def test_new(batches, model, device, num_samples, batch_size, warmup_iters=0):
     model.eval()
-    all_softmax_outputs = []
 
-    with torch.no_grad():
-        for X in dataloader:  #
-            X = X.to(device)
-            pred = model(X)
-            pred_softmax = torch.softmax(pred, dim=1)
-            all_softmax_outputs.extend(pred_softmax.cpu().numpy())
-
-    all_softmax_outputs = np.array(all_softmax_outputs)
-    return all_softmax_outputs
-
-
-def apply_nms(df, iou_threshold):
-    df = df.sort_values("softmax_output_1", ascending=False)
-    boxes = np.array([xywh_to_xyxy(bbox) for bbox in df["bbox"]])
-    scores = df["softmax_output_1"].values
-    boxes = torch.as_tensor(boxes).float()
-    scores = torch.as_tensor(scores).float()
-    keep = nms(boxes, scores, iou_threshold)
-    return df.iloc[keep]
+    # Preallocate the (pinned) host output so device->host copies can run asynchronously
+    all_softmax_outputs = torch.empty(
+        (num_samples, 2), dtype=torch.float32, pin_memory=device.type == "cuda"
+    )
+    offset = 0
+
+    # FP16 autocast only applies on CUDA (tensor cores); CPU runs stay in FP32
+    use_amp = device.type == "cuda"
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type, dtype=torch.float16, enabled=use_amp
+    ):
+        # Warm up compiled models (compilation + CUDA graph capture) on a dummy batch
+        if warmup_iters > 0:
+            dummy = torch.zeros(
+                (batch_size, 3, 224, 224), device=device
+            ).contiguous(memory_format=torch.channels_last)
+            for _ in range(warmup_iters):
+                model(dummy)
+
+        for X in batches:  #
+            n = X.shape[0]
+            if n < batch_size:
+                # Pad the tail batch so every forward pass sees the same static shape
+                X = torch.cat([X, X.new_zeros((batch_size - n, *X.shape[1:]))])
+            X = X.to(device, non_blocking=True, memory_format=torch.channels_last)
+            pred = model(X)[:n]
+            # Upcast logits so the softmax is computed in FP32
+            pred_softmax = torch.softmax(pred.float(), dim=1)
+            all_softmax_outputs[offset : offset + n].copy_(pred_softmax, non_blocking=True)
+            offset += n
+
+    # Wait for the outstanding asynchronous copies once, after the loop
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return all_softmax_outputs.numpy()
+
+
+def apply_nms(df, iou_threshold, device):
+    # Run NMS for every image in a single batched call, using the image as the box group
+    # float64: batched_nms may offset each image's boxes by idx * (max_coord + 1), and at
+    # thousands of images float32 would round those shifted coordinates to ~1px
+    boxes = torch.as_tensor(df[XYXY_COLS].to_numpy(dtype=np.float64), device=device)
+    scores = torch.as_tensor(df["softmax_output_1"].values, dtype=torch.float64, device=device)
+    idxs = torch.as_tensor(pd.factorize(df["image_path"])[0], dtype=torch.int64, device=device)
+    keep = batched_nms(boxes, scores, idxs, iou_threshold)
+    return keep.cpu().numpy()
 
 
 def expand_bbox_columns(df):
-    # Extract bbox components into separate columns
-    bbox_data = df["bbox"].apply(
-        lambda x: pd.Series(x, index=["bbox x", "bbox y", "bbox w", "bbox h"])
-    )
+    # Extract bbox components into one array (missing bboxes become NaN rows)
+    has_bbox = df["bbox"].notna().to_numpy()
+    bbox_data = np.full((len(df), 4), np.nan, dtype=np.float32)
+    if has_bbox.any():
+        bbox_data[has_bbox] = np.asarray(df.loc[has_bbox, "bbox"].tolist(), dtype=np.float32)
+
+    # Precompute corner coordinates once for cropping and NMS
+    xyxy = bbox_data.copy()
+    xyxy[:, 2] += bbox_data[:, 0]
+    xyxy[:, 3] += bbox_data[:, 1]
 
     # Add the new columns to the dataframe
-    df = pd.concat([df, bbox_data], axis=1)
+    bbox_cols = ["bbox x", "bbox y", "bbox w", "bbox h"]
+    df = df.assign(**{col: bbox_data[:, i] for i, col in enumerate(bbox_cols)})
+    df = df.assign(**{col: xyxy[:, i] for i, col in enumerate(XYXY_COLS)})
     return df
 
 
@@ -156,25 +280,52 @@ def main(args):
 
     print(f"The length of input JSON is: {len(df)}")
     filtered_test, filtered_out = filter_dataframe(df, config)
+    # Keep each image's annotations together so its file is read (and decoded) once
+    filtered_test = filtered_test.sort_values("image_path", kind="stable").reset_index(drop=True)
 
     print("Setting up transformations and data loader...")
-    transform = transforms.Compose(
+    # Resize while still uint8 (fast SIMD path), then convert to float and normalize
+    transform = v2.Compose(
         [
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            v2.Resize((224, 224), antialias=True),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ]
     )
-    dataset = CustomImageDataset(filtered_test, transform)
-    dataloader = DataLoader(dataset, batch_size=config["batch_size"], shuffle=False)
+    num_workers = config.get("num_workers", 4)
+    loader_kwargs = dict(
+        batch_size=config["batch_size"],
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=device.type == "cuda",
+        persistent_workers=num_workers > 0,
+        prefetch_factor=2 if num_workers > 0 else None,
+    )
+    if config.get("gpu_decode", False) and device.type == "cuda":
+        # Workers only read raw bytes; decoding, cropping and resizing happen on the GPU
+        dataset = ImageCropsDataset(filtered_test)
+        dataloader = DataLoader(dataset, collate_fn=collate_images, **loader_kwargs)
+        batches = gpu_crop_batches(dataloader, transform, device, config["batch_size"])
+    else:
+        dataset = CustomImageDataset(filtered_test, transform)
+        batches = DataLoader(dataset, **loader_kwargs)
 
     print("Loading model...")
     with warnings.catch_warnings():  # Add this line
         warnings.filterwarnings("ignore", category=UserWarning)
         model = load_model(args.model_checkpoint_path, device)
 
+    # Input shape is static, so CUDA graphs (reduce-overhead) can be captured once and replayed
+    warmup_iters = 0
+    if config.get("compile_model", False) and device.type == "cuda":
+        print("Compiling model...")
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=True)
+        warmup_iters = 3
+
     print("Starting testing...")
-    all_softmax_outputs = test_new(dataloader, model, device)  #
+    all_softmax_outputs = test_new(
+        batches, model, device, len(filtered_test), config["batch_size"], warmup_iters
+    )  #
 
     print(
         "Testing completed. Appending softmax outputs to JSON and starting post-processing..."
@@ -183,54 +334,34 @@ def main(args):
     filtered_test["softmax_output_1"] = all_softmax_outputs[:, 1]
 
     # Step 1: Filter based on threshold_CA
-    above_threshold = filtered_test[
-        filtered_test["softmax_output_1"] > config["threshold_CA"]
-    ].reset_index(drop=True)
-    below_threshold = filtered_test[
-        filtered_test["softmax_output_1"] <= config["threshold_CA"]
-    ].reset_index(drop=True)
+    above_mask = filtered_test["softmax_output_1"].to_numpy() > config["threshold_CA"]
+    above_threshold = filtered_test[above_mask].reset_index(drop=True)
+    below_threshold = filtered_test[~above_mask].reset_index(drop=True)
 
     print(f"The length of softmax thresholded JSON is: {len(above_threshold)}")
 
     # Step 2: Filter based on log(aspect_ratio)
-    above_threshold["log_AR"] = np.log(
-        above_threshold["bbox w"] / above_threshold["bbox h"]
-    )
-    ar_filtered = above_threshold[
-        (above_threshold["log_AR"] >= config["min_log_AR"])
-        & (above_threshold["log_AR"] <= config["max_log_AR"])
-    ].reset_index(drop=True)
-    ar_filtered_out = above_threshold[
-        (above_threshold["log_AR"] < config["min_log_AR"])
-        | (above_threshold["log_AR"] > config["max_log_AR"])
-    ].reset_index(drop=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_ar = np.log(
+            above_threshold["bbox w"].to_numpy() / above_threshold["bbox h"].to_numpy()
+        )
+    above_threshold["log_AR"] = log_ar
+    ar_mask = (log_ar >= config["min_log_AR"]) & (log_ar <= config["max_log_AR"])
+    ar_filtered = above_threshold[ar_mask].reset_index(drop=True)
+    ar_filtered_out = above_threshold[~ar_mask].reset_index(drop=True)
 
     print(f"The length of AR thresholded JSON is: {len(ar_filtered)}")
 
     # Step 3: Apply NMS
-    grouped = ar_filtered.groupby("image_path")
-    all_results = []
-    nms_filtered_out = []
-    for name, group in grouped:
-        result_df = apply_nms(group, config["NMS_threshold"])
-        all_results.append(result_df)
-        # Keep track of removed annotations
-        removed = group[~group.index.isin(result_df.index)]
-        nms_filtered_out.append(removed)
-
-    if all_results:
-        nms_filtered = pd.concat(all_results).reset_index(drop=True)
-        print(f"The length of NMS thresholded JSON is: {len(nms_filtered)}")
-    else:
+    keep = apply_nms(ar_filtered, config["NMS_threshold"], device)
+    keep_mask = np.zeros(len(ar_filtered), dtype=bool)
+    keep_mask[keep] = True
+    nms_filtered = ar_filtered[keep_mask].reset_index(drop=True)
+    # Keep track of removed annotations
+    nms_filtered_out = ar_filtered[~keep_mask].reset_index(drop=True)
+
+    if nms_filtered.empty:
         print("Warning: No objects passed NMS filtering")
-        nms_filtered = pd.DataFrame(
-            columns=ar_filtered.columns
-        )  # Create empty DataFrame with same columns
-
-    if nms_filtered_out:
-        nms_filtered_out = pd.concat(nms_filtered_out).reset_index(drop=True)
-    else:
-        nms_filtered_out = pd.DataFrame(columns=ar_filtered.columns)
 
     # print(nms_filtered_out)
     print(f"The length of NMS thresholded JSON is: {len(nms_filtered)}")
@@ -267,8 +398,7 @@ def main(args):
 
     print("Saving the results...")
     os.makedirs(cac_dir, exist_ok=True)
-    annotations = split_dataframe(final_df)
-    save_json(annotations,args.out_json_path)
+    save_split_dataframe(final_df, args.out_json_path)
 
     print(
         f"JSON with softmax outputs and census annotations saved to: {args.out_json_path}"
@@ -34,7 +34,7 @@ except ImportError:
 
 # Try to import database functions (NEW - for database mode)
 try:
-    from VAREID.libraries.ui.db_scripts import init_db, add_image_pair, get_decisions, check_pair_exists
+    from VAREID.libraries.ui.db_scripts import init_db, add_image_pair, get_decisions, check_pair_exists, serialize_bbox
     DATABASE_AVAILABLE = True
 except ImportError:
     DATABASE_AVAILABLE = False
@@ -135,15 +135,15 @@ def submit_pair_to_database(best_ann1, best_ann2, image_dir, db_path):
     cluster1 = str(best_ann1.get('LCA_clustering_id', 'UNKNOWN'))
     cluster2 = str(best_ann2.get('LCA_clustering_id', 'UNKNOWN'))
 
-    # Extract bounding boxes
+    # Extract bounding boxes (serialized to JSON text once, here)
     bbox1 = None
     bbox2 = None
     if "bbox" in best_ann1 and best_ann1["bbox"]:
         x, y, w, h = best_ann1["bbox"]
-        bbox1 = json.dumps([x, y, x + w, y + h])
+        bbox1 = serialize_bbox([x, y, x + w, y + h])
     if "bbox" in best_ann2 and best_ann2["bbox"]:
         x, y, w, h = best_ann2["bbox"]
-        bbox2 = json.dumps([x, y, x + w, y + h])
+        bbox2 = serialize_bbox([x, y, x + w, y + h])
 
     # Add to database
     add_image_pair(
@@ -6,6 +6,12 @@ import yaml
 
 import pandas as pd
 
+# orjson is optional; it parses JSON several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # DESIRED COLUMNS TO BE KEPT WITHIN ANNOTATIONS
 ANNOTATION_COLNAMES = [
     "uuid",
@@ -81,9 +87,21 @@ def load_dataframe(file_path):
 def load_json(file_path):
     '''
     Load a file (.json) from a given path.
+
+    Parses with orjson when it is installed. orjson rejects the non-standard
+    NaN/Infinity literals that save_json writes for missing values, so files 
+    containing them are sent straight to the json module (a quick byte scan 
+    picks the parser up front, so no file is ever parsed twice).
     '''
-    with open(file_path, "r") as file:
-        return json.load(file)
+    if orjson is None:
+        with open(file_path, "r") as file:
+            return json.load(file)
+
+    with open(file_path, "rb") as file:
+        raw = file.read()
+    if b"NaN" in raw or b"Infinity" in raw:
+        return json.loads(raw)
+    return orjson.loads(raw)
     
 
 def save_json(file, file_path):
@@ -114,19 +132,15 @@ def save_csv(file, file_path):
     df.to_csv(file_path, index=False)
 
 
-def split_dataframe(df):
+def split_dataframe_sections(df):
     '''
     Reads in pandas dataframe format of annotations. Splits the 
     dataframe into three segments (categories, images, and annotations).
     The fields for each of these categories are described at the top 
     of this file. 
 
-    Returns a record-based annotations json object like the following:
-    {
-        categories: [{}]
-        images: [{}, {}]
-        annotations: [{}, {}, {}, {}]
-    }
+    Returns a dictionary of the three dataframe sections, keyed by
+    "categories", "images", and "annotations".
     '''
 
     # OBTAIN THE IMAGES SECTION
@@ -153,13 +167,50 @@ def split_dataframe(df):
     annot_cols = df.columns.intersection(ANNOTATION_COLNAMES)
     df_annots = df[annot_cols]
 
-    final_json = {
-        "categories": df_categories.to_dict(orient="records"),
-        "images": df_images.to_dict(orient="records"),
-        "annotations": df_annots.to_dict(orient="records"),
+    return {
+        "categories": df_categories,
+        "images": df_images,
+        "annotations": df_annots,
     }
 
-    return final_json
+
+def split_dataframe(df):
+    '''
+    Reads in pandas dataframe format of annotations. Splits the 
+    dataframe into three segments (categories, images, and annotations).
+    The fields for each of these categories are described at the top 
+    of this file. 
+
+    Returns a record-based annotations json object like the following:
+    {
+        categories: [{}]
+        images: [{}, {}]
+        annotations: [{}, {}, {}, {}]
+    }
+    '''
+    sections = split_dataframe_sections(df)
+    return {key: section.to_dict(orient="records") for key, section in sections.items()}
+
+
+def save_split_dataframe(df, file_path):
+    '''
+    Split a pandas dataframe of annotations (see split_dataframe) and save
+    it directly to JSON. Equivalent to save_json(split_dataframe(df), file_path),
+    but each section is serialized by pandas' C writer instead of being 
+    converted to python dicts and encoded by the json module.
+
+    NOTE: Missing values are written as null rather than NaN.
+    '''
+    sections = split_dataframe_sections(df)
+    with open(file_path, "w", encoding="utf-8") as json_file:
+        json_file.write("{\n")
+        for i, (key, section) in enumerate(sections.items()):
+            json_file.write(f'    "{key}": ')
+            json_file.write(
+                section.to_json(orient="records", double_precision=15, force_ascii=False)
+            )
+            json_file.write(",\n" if i < len(sections) - 1 else "\n")
+        json_file.write("}\n")
 
 
 def join_dataframe(annots):
@@ -1,7 +1,8 @@
-from db_scripts import init_db, add_image_pair
+from db_scripts import init_db, add_image_pairs_bulk
 import argparse
 import os
 import random
+import uuid
 
 def add_random_pairs(image_dir, db_path, num_pairs=20):
     # image_files = [
@@ -25,9 +26,11 @@ def add_random_pairs(image_dir, db_path, num_pairs=20):
         raise ValueError("Need at least 2 images to form a pair.")
 
 
+    pairs = []
     for _ in range(num_pairs):
         img1, img2 = random.sample(image_files, 2)
-        add_image_pair("", img1, "", img2, db_path)
+        pairs.append((str(uuid.uuid4()), "", img1, None, "", "", img2, None, ""))
+    add_image_pairs_bulk(pairs, db_path)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Initialize database and insert image pairs.")